@@ -1,10 +1,14 @@
 import os
 import sys
-import requests
+import asyncio
+import aiohttp
 import random
-import json
+import orjson
 import re
-from threading import Timer
+import functools
+import hashlib
+import cachetools
+import numpy as np
 from dotenv import load_dotenv
 import openai  # For OpenAI interaction
 import logging
@@ -30,218 +34,660 @@ if LOGGING:
 else:
     logger.disabled = True
 
+def normalize_server_url(target_server):
+    # Ensure the target server includes the schema
+    if target_server and not target_server.startswith("http://") and not target_server.startswith("https://"):
+        target_server = "https://" + target_server
+    return target_server
+
+# Canvas server details, read once at startup
+TARGET_SERVER = normalize_server_url(os.getenv('TARGET_SERVER', '').strip())
+API_KEY = os.getenv('API_KEY', '').strip()
+CANVAS_HEADERS = {'Private-Token': API_KEY}
+
+CANVASES_URL = f"{TARGET_SERVER}/api/v1/canvases"
+NOTES_URL_TEMPLATE = f"{TARGET_SERVER}/api/v1/canvases/{{canvas_id}}/notes"
+NOTE_URL_TEMPLATE = f"{TARGET_SERVER}/api/v1/canvases/{{canvas_id}}/notes/{{note_id}}"
+IMAGES_URL_TEMPLATE = f"{TARGET_SERVER}/api/v1/canvases/{{canvas_id}}/images"
+
+# Canvas to monitor. Its ID is looked up by name on first use unless CANVAS_ID is set,
+# and only looked up again if the server stops recognising it.
+CANVAS_NAME = os.getenv('CANVAS_NAME', 'JP-API-TEST').strip()
+canvas_id_cache = os.getenv('CANVAS_ID', '').strip() or None
+
+# ETag (or, failing that, body digest) of the last notes response per canvas,
+# used to skip polls where nothing has changed
+NOTES_ETAGS = {}
+NOTES_DIGESTS = {}
+
+# Timeout applied to every request sent to the Canvas server
+CANVAS_TIMEOUT = aiohttp.ClientTimeout(total=10)
+
+# Receive note changes over a long-lived '?subscribe' request instead of polling.
+# Polling is still used when the server does not support subscriptions.
+CANVAS_SUBSCRIBE = os.getenv('CANVAS_SUBSCRIBE', '1').strip() == '1'
+# The server sends keep-alives on idle subscriptions, so a long silence means the connection is dead
+SUBSCRIBE_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=60)
+SUBSCRIBE_RETRY_DELAY = 2.0
+# Responses meaning the server has no subscription support for the notes endpoint
+SUBSCRIBE_UNSUPPORTED_STATUSES = {400, 404, 405, 501}
+
+# Tasks handling pushed note changes, referenced here so they are not garbage collected
+background_tasks = set()
+
+# Authorization header for the direct OpenAI HTTP calls, set once the API key has been validated
+openai_headers = None
+
+OPENAI_CHAT_URL = "https://api.openai.com/v1/chat/completions"
+OPENAI_IMAGE_URL = "https://api.openai.com/v1/images/generations"
+OPENAI_EMBEDDING_URL = "https://api.openai.com/v1/embeddings"
+OPENAI_EMBEDDING_MODEL = "text-embedding-3-small"
+
+# Cap the number of requests in flight to stay within OpenAI and Canvas rate limits
+OPENAI_SEM = asyncio.Semaphore(int(os.getenv('OPENAI_MAX_CONCURRENCY', '8')))
+CANVAS_SEM = asyncio.Semaphore(int(os.getenv('CANVAS_MAX_CONCURRENCY', '16')))
+
+OPENAI_MAX_RETRIES = 5
+
+# Successful OpenAI key validations (SHA-256 of the key -> timestamp), reused for an hour
+KEY_VALIDATION_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'canvusapi-llm', 'keyvalid.json')
+KEY_VALIDATION_TTL = 3600
+
+# System prompt sent with every instruction
+SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": (
+        "You are an assistant that can generate text or images based on user instructions. "
+        "For the following instruction, decide whether to generate text or an image. "
+        "If you decide to generate text, respond with a JSON object like this:\n"
+        '{"type": "text", "content": "<the text you generated>"}\n'
+        "If you decide to generate an image, respond with a JSON object like this:\n"
+        '{"type": "image", "content": "<the description of the image to generate>"}\n'
+        "Do not include any additional text or explanations in your response."
+    )
+}
+
+# Parsed OpenAI responses keyed by a hash of the normalized instruction text
+RESPONSE_CACHE_SIZE = 1024
+RESPONSE_CACHE = cachetools.LRUCache(maxsize=RESPONSE_CACHE_SIZE)
+
+# Optional semantic tier: reuse a response when a new instruction's embedding is
+# close enough to one already answered. Costs an embedding call per cache miss.
+SEMANTIC_CACHE = os.getenv('SEMANTIC_CACHE', '0').strip() == '1'
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv('SEMANTIC_CACHE_THRESHOLD', '0.95'))
+semantic_vectors = None  # One unit-length row per cached instruction
+semantic_responses = []
+
+# Downloaded PNG bytes keyed by (image description, size)
+IMAGE_CACHE = cachetools.LRUCache(maxsize=128)
+
+def retry_on_rate_limit(func):
+    """Retry an OpenAI call with randomized exponential backoff when rate limited."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        for attempt in range(OPENAI_MAX_RETRIES):
+            try:
+                return await func(*args, **kwargs)
+            except aiohttp.ClientResponseError as e:
+                if e.status != 429 or attempt == OPENAI_MAX_RETRIES - 1:
+                    raise
+                delay = 2 ** attempt + random.random()
+                logger.warning(f"OpenAI rate limit hit ({e.message}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+    return wrapper
+
+CANVAS_MAX_RETRIES = 3
+CANVAS_RETRY_STATUSES = {502, 503, 504}
+
+def retry_on_server_error(func):
+    """Retry an idempotent Canvas request with exponential backoff on transient gateway errors."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        for attempt in range(CANVAS_MAX_RETRIES + 1):
+            try:
+                return await func(*args, **kwargs)
+            except aiohttp.ClientResponseError as e:
+                if e.status not in CANVAS_RETRY_STATUSES or attempt == CANVAS_MAX_RETRIES:
+                    raise
+                delay = 0.3 * 2 ** attempt
+                logger.warning(f"Canvas server returned HTTP {e.status}, retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+    return wrapper
+
+async def raise_for_openai_status(response):
+    """Like response.raise_for_status(), but keeps the error message from OpenAI's JSON body."""
+    if response.status < 400:
+        return
+    body = await response.read()
+    try:
+        message = orjson.loads(body)['error']['message']
+    except (orjson.JSONDecodeError, KeyError, TypeError):
+        message = body.decode(errors='replace') or response.reason
+    raise aiohttp.ClientResponseError(
+        response.request_info,
+        response.history,
+        status=response.status,
+        message=message,
+        headers=response.headers
+    )
+
+# The chat and image calls bypass the OpenAI client and POST directly over the
+# shared aiohttp session, which holds up much better under high concurrency.
+@retry_on_rate_limit
+async def openai_chat(session, messages, model="gpt-4o-mini", **params):
+    """Stream a chat completion and return the assembled reply text."""
+    payload = {"model": model, "messages": messages, "stream": True, **params}
+    chunks = []
+    async with OPENAI_SEM, session.post(OPENAI_CHAT_URL, json=payload, headers=openai_headers) as response:
+        await raise_for_openai_status(response)
+        # Server-sent events: one 'data: {...}' line per chunk, terminated by 'data: [DONE]'
+        async for line in response.content:
+            if not line.startswith(b'data: '):
+                continue
+            data = line[len(b'data: '):].strip()
+            if data == b'[DONE]':
+                break
+            choices = orjson.loads(data)['choices']
+            if choices:
+                chunks.append(choices[0]['delta'].get('content') or '')
+    return ''.join(chunks)
+
+@retry_on_rate_limit
+async def openai_image(session, prompt, **params):
+    payload = {"prompt": prompt, **params}
+    async with OPENAI_SEM, session.post(OPENAI_IMAGE_URL, json=payload, headers=openai_headers) as response:
+        await raise_for_openai_status(response)
+        return orjson.loads(await response.read())
+
+@retry_on_rate_limit
+async def openai_embedding(session, text):
+    payload = {"model": OPENAI_EMBEDDING_MODEL, "input": text}
+    async with OPENAI_SEM, session.post(OPENAI_EMBEDDING_URL, json=payload, headers=openai_headers) as response:
+        await raise_for_openai_status(response)
+        result = orjson.loads(await response.read())
+    embedding = np.asarray(result['data'][0]['embedding'], dtype=np.float32)
+    # Unit-normalize so a dot product gives the cosine similarity
+    return embedding / np.linalg.norm(embedding)
+
+# Regular expression pattern to find text that starts with '{{' and ends with '}}'
+INSTRUCTION_PATTERN = re.compile(r'^\{\{(.*?)\}\}$', re.DOTALL)
+
+# Text of notes that needed no further work (or were already dispatched) when last
+# seen, keyed by note ID. A note is looked at again only once its text changes.
+HANDLED_NOTES = cachetools.LRUCache(maxsize=8192)
+
+@functools.lru_cache(maxsize=4096)
+def extract_instruction(note_text):
+    """Return the instruction wrapped in '{{ }}', or None if the note holds none."""
+    # Cheap prefix/suffix check rules out most notes without touching the regex
+    if not (note_text.startswith('{{') and note_text.endswith('}}')):
+        return None
+    match = INSTRUCTION_PATTERN.match(note_text)
+    return match.group(1).strip() if match else None
+
+# Validate Canvas server settings
+def validate_canvas_settings():
+    logger.debug("TARGET_SERVER: %s", TARGET_SERVER)
+    if not TARGET_SERVER or not API_KEY:
+        logger.error("TARGET_SERVER or API_KEY is not set.")
+        sys.exit(1)
+
+def load_key_validations():
+    try:
+        with open(KEY_VALIDATION_CACHE, 'rb') as f:
+            validations = orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        return {}
+    return validations if isinstance(validations, dict) else {}
+
+def save_key_validations(validations):
+    try:
+        os.makedirs(os.path.dirname(KEY_VALIDATION_CACHE), exist_ok=True)
+        # Write to a temporary file and swap it in so a concurrent start never reads a partial file
+        temp_path = f"{KEY_VALIDATION_CACHE}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(orjson.dumps(validations))
+        os.replace(temp_path, KEY_VALIDATION_CACHE)
+    except OSError as e:
+        logger.warning(f"Could not save OpenAI API key validation cache: {e}")
+
 # Validate OpenAI API Key
-def validate_openai_api_key():
+async def validate_openai_api_key():
+    global openai_headers
     openai_api_key = os.getenv('OPENAI_API_KEY', '').strip()
     logger.debug("Validating OpenAI API Key.")
     if not openai_api_key:
         logger.error("OPENAI_API_KEY is not set or is empty.")
         sys.exit(1)
     else:
-        openai.api_key = openai_api_key
+        openai_headers = {'Authorization': f'Bearer {openai_api_key}'}
+
+        # Skip the round-trip if this key was validated recently (e.g. on a quick restart)
+        key_hash = hashlib.sha256(openai_api_key.encode()).hexdigest()
+        validations = load_key_validations()
+        validated_at = validations.get(key_hash)
+        if isinstance(validated_at, (int, float)) and validated_at > time.time() - KEY_VALIDATION_TTL:
+            logger.info("OpenAI API key is valid (cached validation).")
+            return
+
+        openai_client = openai.AsyncOpenAI(api_key=openai_api_key)
         try:
             # Make a simple API call to test the key
-            openai.Model.list()
+            await openai_client.models.list()
             logger.info("OpenAI API key is valid.")
-        except openai.error.AuthenticationError:
+            validations[key_hash] = time.time()
+            save_key_validations(validations)
+        except openai.AuthenticationError:
             logger.error("Invalid OpenAI API key.")
             sys.exit(1)
-        except openai.error.OpenAIError as e:
+        except openai.OpenAIError as e:
             logger.error(f"An error occurred while validating OpenAI API key: {e}")
             sys.exit(1)
 
-def main():
+async def main():
     logger.info("Starting the monitoring script")
-    validate_openai_api_key()
-    schedule_monitoring()
-
-def schedule_monitoring():
-    interval = 2.0  # Interval in seconds
-
-    def run_monitor():
+    validate_canvas_settings()
+    await validate_openai_api_key()
+    # One session (and connection pool) is shared by every Canvas and OpenAI request
+    connector = aiohttp.TCPConnector(limit=64, keepalive_timeout=60, ttl_dns_cache=300)
+    # Request bodies passed as json= are encoded with orjson rather than the stdlib
+    async with aiohttp.ClientSession(connector=connector, json_serialize=lambda obj: orjson.dumps(obj).decode()) as session:
+        await schedule_monitoring(session)
+
+async def subscribe_canvas_notes(session):
+    """Handle note changes as the Canvas server pushes them over a subscription.
+
+    Returns if the server does not support subscriptions so the caller can fall
+    back to polling. Dropped connections are re-established.
+    """
+    global canvas_id_cache
+    while True:
         try:
-            monitor_canvas_notes()
+            canvas_id_was_cached = canvas_id_cache is not None
+            canvas_id = await get_canvas_id(session)
+            subscribe_endpoint = NOTES_URL_TEMPLATE.format(canvas_id=canvas_id) + '?subscribe'
+            logger.info(f"Subscribing to notes at {subscribe_endpoint}")
+            async with session.get(subscribe_endpoint, headers=CANVAS_HEADERS, timeout=SUBSCRIBE_TIMEOUT) as response:
+                if response.status == 404 and canvas_id_was_cached:
+                    # The cached canvas is gone; look it up again before giving up on subscribing
+                    logger.warning(f"Canvas ID {canvas_id} not found, resolving '{CANVAS_NAME}' again")
+                    canvas_id_cache = None
+                    continue
+                if response.status in SUBSCRIBE_UNSUPPORTED_STATUSES:
+                    logger.warning(f"Note subscription unavailable (HTTP {response.status}), falling back to polling")
+                    return
+                # Anything else (auth failures, 5xx) is retried after a delay
+                response.raise_for_status()
+                # A server that ignores '?subscribe' answers with an ordinary, sized notes
+                # list; a subscription is streamed without a Content-Length
+                if response.content_length is not None:
+                    logger.warning("Canvas server does not stream note changes, falling back to polling")
+                    return
+
+                # The server sends the current notes, then each change, one JSON document
+                # per line; blank lines are keep-alives
+                documents = 0
+                buffer = bytearray()
+                async for chunk in response.content.iter_any():
+                    buffer.extend(chunk)
+                    lines = []
+                    while (newline := buffer.find(b'\n')) != -1:
+                        lines.append(bytes(buffer[:newline]))
+                        del buffer[:newline + 1]
+                    documents += dispatch_note_lines(session, canvas_id, lines)
+                # The last document may not be newline-terminated
+                documents += dispatch_note_lines(session, canvas_id, [bytes(buffer)])
+
+            # e.g. the server restarted; an idle canvas may have sent only the initial list
+            logger.info(f"Note subscription closed by the server after {documents} document(s), reconnecting in {SUBSCRIBE_RETRY_DELAY}s")
+            await asyncio.sleep(SUBSCRIBE_RETRY_DELAY)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"Note subscription interrupted: {e}, reconnecting")
+            await asyncio.sleep(SUBSCRIBE_RETRY_DELAY)
         except Exception as e:
-            logger.exception(f"Error occurred during monitoring: {e}")
-        finally:
-            Timer(interval, run_monitor).start()
-
-    run_monitor()
-
-def monitor_canvas_notes():
-    logger.info("Running monitor_canvas_notes")
-
-    # Get environment variables for Canvas server details
-    target_server = os.getenv('TARGET_SERVER', '').strip()
-    api_key = os.getenv('API_KEY', '').strip()
+            logger.exception(f"Error occurred during note subscription: {e}")
+            await asyncio.sleep(SUBSCRIBE_RETRY_DELAY)
+
+def dispatch_note_lines(session, canvas_id, lines):
+    """Handle the notes in a group of JSON lines as one batch, returning how many documents there were."""
+    # Collect every change in the group so their 'processing' PATCHes go out together
+    changed_notes = {}
+    documents = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        # Skip malformed lines on their own so the rest of the batch and the connection survive
+        try:
+            event = orjson.loads(line)
+        except orjson.JSONDecodeError as e:
+            logger.warning(f"Ignoring malformed line in note subscription: {e}")
+            continue
+        notes = event if isinstance(event, list) else [event]
+        if not all(isinstance(note, dict) for note in notes):
+            logger.warning("Ignoring non-note document in note subscription: %s", event)
+            continue
+        documents += 1
+        for note in notes:
+            changed_notes[note.get('id')] = note
+    if changed_notes:
+        dispatch_notes(session, canvas_id, list(changed_notes.values()))
+    return documents
 
-    # Log the environment variables
-    logger.debug(f"TARGET_SERVER: {target_server}")
-    logger.debug(f"API_KEY: {api_key}")
+def dispatch_notes(session, canvas_id, notes):
+    # Handle the notes in the background so the subscription keeps being read
+    task = asyncio.create_task(handle_notes(session, canvas_id, notes))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
 
-    # Ensure the target server includes the schema
-    if not target_server.startswith("http://") and not target_server.startswith("https://"):
-        target_server = "https://" + target_server
+async def schedule_monitoring(session):
+    if CANVAS_SUBSCRIBE:
+        await subscribe_canvas_notes(session)
 
-    # If target_server or api_key are not properly set, log and raise an error
-    if not target_server or not api_key:
-        error_message = "TARGET_SERVER or API_KEY is not set."
-        logger.error(error_message)
-        raise ValueError(error_message)
+    interval = 2.0  # Interval in seconds
+    loop = asyncio.get_running_loop()
 
-    # Define the endpoint to get all canvases and find the one named 'JP-API-TEST'
-    canvases_endpoint = f"{target_server}/api/v1/canvases"
-    headers = {'Private-Token': api_key}
-    try:
-        logger.info(f"Requesting canvases from {canvases_endpoint}")
-        response = requests.get(canvases_endpoint, headers=headers, timeout=10)
-        logger.debug(f"Response Status Code: {response.status_code}")
-        logger.debug(f"Response Body: {response.text}")
+    while True:
+        start = loop.time()
+        try:
+            await monitor_canvas_notes(session)
+        except Exception as e:
+            logger.exception(f"Error occurred during monitoring: {e}")
+        # Sleep only for what is left of the interval so polls start on a steady cadence
+        await asyncio.sleep(max(0.0, interval - (loop.time() - start)))
+
+async def batch_patch_notes(session, canvas_id, updates):
+    """PATCH several notes concurrently, returning each response status or the exception raised.
+
+    Canvas has no bulk note update endpoint, so the requests are pipelined over
+    the session's keep-alive connection pool instead.
+    """
+    async def patch_note(note_id, update_data):
+        update_note_endpoint = NOTE_URL_TEMPLATE.format(canvas_id=canvas_id, note_id=note_id)
+        async with CANVAS_SEM, session.patch(update_note_endpoint, json=update_data, headers=CANVAS_HEADERS, timeout=CANVAS_TIMEOUT) as response:
+            logger.debug("Response Status Code: %s", response.status)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Response Body: %s", await response.text())
+            response.raise_for_status()
+            return response.status
+
+    return await asyncio.gather(
+        *(patch_note(note_id, update_data) for note_id, update_data in updates),
+        return_exceptions=True
+    )
+
+@retry_on_server_error
+async def resolve_canvas_id(session, canvas_name):
+    """Look up the ID of the canvas called `canvas_name`, or None if there is no such canvas."""
+    logger.info(f"Requesting canvases from {CANVASES_URL}")
+    async with CANVAS_SEM, session.get(CANVASES_URL, headers=CANVAS_HEADERS, timeout=CANVAS_TIMEOUT) as response:
+        logger.debug("Response Status Code: %s", response.status)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Response Body: %s", await response.text())
         response.raise_for_status()
-        canvases = response.json()
-        logger.debug(f"Retrieved canvases: {canvases}")
+        canvases = orjson.loads(await response.read())
+    logger.debug("Retrieved canvases: %s", canvases)
 
-        canvas_id = None
+    return next((canvas.get('id') for canvas in canvases if canvas.get('name') == canvas_name), None)
 
-        # Find the canvas named 'JP-API-TEST'
-        for canvas in canvases:
-            logger.debug(f"Checking canvas: {canvas.get('name')}")
-            if canvas.get('name') == 'JP-API-TEST':
-                canvas_id = canvas.get('id')
-                logger.info(f"Found canvas 'JP-API-TEST' with ID: {canvas_id}")
-                break
+async def get_canvas_id(session):
+    """Return the monitored canvas ID, resolving it by name only when not already known."""
+    global canvas_id_cache
+    if canvas_id_cache is None:
+        canvas_id = await resolve_canvas_id(session, CANVAS_NAME)
 
         # If the canvas is not found, log and raise an error
         if not canvas_id:
-            error_message = "Canvas 'JP-API-TEST' not found."
+            error_message = f"Canvas '{CANVAS_NAME}' not found."
             logger.error(error_message)
             raise ValueError(error_message)
 
-        # Monitor the canvas for notes containing '{{ }}' at the start and end
-        monitor_notes_endpoint = f"{target_server}/api/v1/canvases/{canvas_id}/notes"
-        logger.info(f"Requesting notes from {monitor_notes_endpoint}")
-        response = requests.get(monitor_notes_endpoint, headers=headers, timeout=10)
-        logger.debug(f"Response Status Code: {response.status_code}")
-        logger.debug(f"Response Body: {response.text}")
+        logger.info(f"Found canvas '{CANVAS_NAME}' with ID: {canvas_id}")
+        canvas_id_cache = canvas_id
+    return canvas_id_cache
+
+@retry_on_server_error
+async def fetch_notes(session, canvas_id):
+    """Return the notes on a canvas, or None if they are unchanged since the last poll."""
+    headers = CANVAS_HEADERS
+    etag = NOTES_ETAGS.get(canvas_id)
+    if etag:
+        headers = {**CANVAS_HEADERS, 'If-None-Match': etag}
+
+    monitor_notes_endpoint = NOTES_URL_TEMPLATE.format(canvas_id=canvas_id)
+    logger.info(f"Requesting notes from {monitor_notes_endpoint}")
+    async with CANVAS_SEM, session.get(monitor_notes_endpoint, headers=headers, timeout=CANVAS_TIMEOUT) as response:
+        logger.debug("Response Status Code: %s", response.status)
+        if response.status == 304:
+            logger.info("Notes unchanged since last poll")
+            return None
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Response Body: %s", await response.text())
         response.raise_for_status()
-        notes = response.json()
-        logger.debug(f"Retrieved notes: {notes}")
+        body = await response.read()
+        etag = response.headers.get('ETag')
 
-        # Regular expression pattern to find text that starts with '{{' and ends with '}}'
-        pattern = re.compile(r'^{{(.*?)}}$', re.DOTALL)
-
-        # Iterate over notes to find those containing '{{ }}'
-        for note in notes:
-            note_text = note.get('text', '')
-            logger.debug(f"Processing note ID: {note.get('id')} with text: {note_text}")
-
-            match = pattern.search(note_text)
-            if match:
-                instruction_text = match.group(1).strip()
-                logger.info(f"Found instruction in note ID {note.get('id')}: {instruction_text}")
-
-                # Update the note immediately to mark it as 'processing' by replacing '}}' with '!!Processing!!'
-                updated_text = note_text.replace('}}', '!!Processing!!')
-                update_note_endpoint = f"{target_server}/api/v1/canvases/{canvas_id}/notes/{note['id']}"
-                update_data = {"text": updated_text}
-                logger.info(f"Updating note ID {note['id']} to mark as processing")
-                response = requests.patch(update_note_endpoint, json=update_data, headers=headers, timeout=10)
-                logger.debug(f"Response Status Code: {response.status_code}")
-                logger.debug(f"Response Body: {response.text}")
-                response.raise_for_status()
+    if etag:
+        NOTES_ETAGS[canvas_id] = etag
+    else:
+        # The server sent no ETag, so compare a digest of the body instead
+        digest = hashlib.blake2b(body, digest_size=16).digest()
+        if NOTES_DIGESTS.get(canvas_id) == digest:
+            logger.info("Notes unchanged since last poll")
+            return None
+        NOTES_DIGESTS[canvas_id] = digest
+
+    notes = orjson.loads(body)
+    logger.debug("Retrieved notes: %s", notes)
+    return notes
+
+def forget_notes_version(canvas_id):
+    # Make the next poll re-read the notes even if they have not changed
+    NOTES_ETAGS.pop(canvas_id, None)
+    NOTES_DIGESTS.pop(canvas_id, None)
+
+async def handle_notes(session, canvas_id, notes):
+    """Find new '{{ }}' instructions among `notes`, mark them as processing and process them."""
+    # Iterate over notes to find those containing '{{ }}'
+    matches = []
+    updates = []
+    for note in notes:
+        note_id = note.get('id')
+        note_text = note.get('text', '')
+
+        # Skip notes already seen with the same text
+        if HANDLED_NOTES.get(note_id) == note_text:
+            continue
+        logger.debug("Processing note ID: %s with text: %s", note_id, note_text)
+
+        if '!!Processing!!' in note_text or '!! Done !!' in note_text:
+            instruction_text = None
+        else:
+            instruction_text = extract_instruction(note_text)
+        if instruction_text is not None:
+            logger.info(f"Found instruction in note ID {note_id}: {instruction_text}")
+
+            # Mark the note as 'processing' by replacing '}}' with '!!Processing!!'
+            updated_text = note_text.replace('}}', '!!Processing!!')
+            updates.append((note_id, {"text": updated_text}))
+            # Guard against picking the same instruction up again while it is in flight
+            HANDLED_NOTES[note_id] = note_text
+            matches.append(({**note, 'text': updated_text}, instruction_text))
+        else:
+            logger.debug("No unprocessed instruction found in note ID %s", note_id)
+            HANDLED_NOTES[note_id] = note_text
+
+    if matches:
+        # Send all 'processing' updates for this batch at once
+        logger.info(f"Marking {len(updates)} note(s) as processing")
+        results = await batch_patch_notes(session, canvas_id, updates)
+        marked = []
+        for (note, instruction_text), result in zip(matches, results):
+            if isinstance(result, BaseException):
+                logger.error(f"Failed to mark note ID {note['id']} as processing: {result}")
+                # Let this note be picked up again
+                HANDLED_NOTES.pop(note['id'], None)
+                forget_notes_version(canvas_id)
+            else:
                 logger.info(f"Note ID {note['id']} marked as processing")
+                marked.append((note, instruction_text))
 
-                # Process the instruction
-                process_instruction(canvas_id, note['id'], instruction_text)
-                logger.info(f"process_instruction called for note ID {note['id']}")
-            else:
-                logger.debug(f"No unprocessed instruction found in note ID {note.get('id')}")
+        # Process all instructions found in this batch concurrently
+        logger.info(f"Dispatching {len(marked)} instruction(s)")
+        await asyncio.gather(*[
+            process_instruction(session, canvas_id, note, instruction_text)
+            for note, instruction_text in marked
+        ], return_exceptions=True)
+
+async def monitor_canvas_notes(session):
+    global canvas_id_cache
+    logger.info("Running monitor_canvas_notes")
+
+    try:
+        canvas_id = await get_canvas_id(session)
 
-    except requests.exceptions.RequestException as e:
-        logger.exception("A RequestException occurred: %s", e)
+        # Monitor the canvas for notes containing '{{ }}' at the start and end
+        try:
+            notes = await fetch_notes(session, canvas_id)
+        except aiohttp.ClientResponseError as e:
+            if e.status != 404:
+                raise
+            # The cached canvas is gone; look it up again and retry once
+            logger.warning(f"Canvas ID {canvas_id} not found, resolving '{CANVAS_NAME}' again")
+            canvas_id_cache = None
+            canvas_id = await get_canvas_id(session)
+            notes = await fetch_notes(session, canvas_id)
+
+        if notes is None:
+            return
+
+        await handle_notes(session, canvas_id, notes)
+
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.exception("A ClientError occurred: %s", e)
         raise
     except Exception as e:
         logger.exception("An unexpected error occurred: %s", e)
         raise
 
-def process_instruction(canvas_id, note_id, instruction_text):
-    logger.info(f"Processing instruction for note ID {note_id}")
-    logger.debug(f"Instruction text: {instruction_text}")
-
-    # Get environment variables for Canvas server details
-    target_server = os.getenv('TARGET_SERVER', '').strip()
-    api_key = os.getenv('API_KEY', '').strip()
-
-    # Log the environment variables
-    logger.debug(f"TARGET_SERVER: {target_server}")
-    logger.debug(f"API_KEY: {api_key}")
+def response_cache_key(instruction_text):
+    # Normalize whitespace and case so trivially different prompts share an entry
+    normalized = ' '.join(instruction_text.split()).casefold()
+    return hashlib.blake2b(normalized.encode(), digest_size=16).digest()
+
+def find_similar_response(embedding):
+    """Return the cached response whose instruction is most similar to `embedding`, if close enough."""
+    if semantic_vectors is None:
+        return None
+    similarities = semantic_vectors @ embedding
+    best = int(np.argmax(similarities))
+    if similarities[best] < SEMANTIC_CACHE_THRESHOLD:
+        return None
+    logger.debug("Semantic cache hit with similarity %.3f", similarities[best])
+    return semantic_responses[best]
+
+def remember_embedding(embedding, response_data):
+    global semantic_vectors
+    if semantic_vectors is None:
+        semantic_vectors = embedding[np.newaxis, :]
+    else:
+        semantic_vectors = np.vstack((semantic_vectors, embedding))
+    semantic_responses.append(response_data)
+    # Drop the oldest entries once the cache is full
+    if len(semantic_responses) > RESPONSE_CACHE_SIZE:
+        semantic_vectors = semantic_vectors[-RESPONSE_CACHE_SIZE:]
+        del semantic_responses[:-RESPONSE_CACHE_SIZE]
+
+async def get_response_data(session, instruction_text):
+    """Return the parsed OpenAI response for an instruction, reusing cached responses where possible."""
+    cache_key = response_cache_key(instruction_text)
+    response_data = RESPONSE_CACHE.get(cache_key)
+    if response_data is not None:
+        logger.info("Reusing cached OpenAI response for identical instruction")
+        return response_data
+
+    embedding = None
+    if SEMANTIC_CACHE:
+        embedding = await openai_embedding(session, instruction_text)
+        response_data = find_similar_response(embedding)
+        if response_data is not None:
+            logger.info("Reusing cached OpenAI response for similar instruction")
+            RESPONSE_CACHE[cache_key] = response_data
+            return response_data
+
+    response_data = await request_response_data(session, instruction_text)
+    # Only cache responses process_instruction knows how to handle
+    if isinstance(response_data, dict) and response_data.get('type') in ('text', 'image'):
+        RESPONSE_CACHE[cache_key] = response_data
+        if embedding is not None:
+            remember_embedding(embedding, response_data)
+    return response_data
+
+async def request_response_data(session, instruction_text):
+    # Prepare messages for ChatCompletion
+    messages = [
+        SYSTEM_MESSAGE,
+        {
+            "role": "user",
+            "content": instruction_text
+        }
+    ]
+
+    logger.info("Sending request to OpenAI ChatCompletion")
+    response_text = await openai_chat(
+        session,
+        messages,
+        model="gpt-4o-mini",  # Faster and cheaper per token than gpt-3.5-turbo
+        max_tokens=500,
+        temperature=0.7,
+        response_format={"type": "json_object"}  # Constrain the reply to a JSON object
+    )
+    response_text = response_text.strip()
+    logger.debug("OpenAI response: %s", response_text)
+
+    # Parse the response as JSON
+    try:
+        response_data = orjson.loads(response_text)
+        logger.debug("Parsed OpenAI response: %s", response_data)
+    except orjson.JSONDecodeError as e:
+        logger.error("Failed to parse OpenAI response as JSON: %s", e)
+        raise
 
-    # Ensure the target server includes the schema
-    if not target_server.startswith("http://") and not target_server.startswith("https://"):
-        target_server = "https://" + target_server
+    return response_data
+
+async def upload_image(session, canvas_id, new_image_json, image_data):
+    """Create an image on the canvas from the PNG bytes in `image_data`."""
+    create_image_endpoint = IMAGES_URL_TEMPLATE.format(canvas_id=canvas_id)
+    logger.info(f"Creating new image at {create_image_endpoint}")
+
+    # Prepare the multipart/form-data request. Upload buffered bytes so the request
+    # carries a Content-Length; the image cache needs the full bytes anyway.
+    form = aiohttp.MultipartWriter('form-data')
+    json_part = form.append(orjson.dumps(new_image_json), {'Content-Type': 'application/json'})
+    json_part.set_content_disposition('form-data', name='json')
+    image_part = form.append(image_data, {'Content-Type': 'image/png'})
+    image_part.set_content_disposition('form-data', name='data', filename='image.png')
+
+    async with CANVAS_SEM, session.post(create_image_endpoint, headers=CANVAS_HEADERS, data=form, timeout=CANVAS_TIMEOUT) as response:
+        logger.debug("Response Status Code: %s", response.status)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Response Body: %s", await response.text())
+        response.raise_for_status()
 
-    headers = {'Private-Token': api_key}
+async def process_instruction(session, canvas_id, note, instruction_text):
+    note_id = note['id']
+    logger.info(f"Processing instruction for note ID {note_id}")
+    logger.debug("Instruction text: %s", instruction_text)
 
     try:
-        # Prepare messages for ChatCompletion
-        messages = [
-            {
-                "role": "system",
-                "content": (
-                    "You are an assistant that can generate text or images based on user instructions. "
-                    "For the following instruction, decide whether to generate text or an image. "
-                    "If you decide to generate text, respond with a JSON object like this:\n"
-                    '{"type": "text", "content": "<the text you generated>"}\n'
-                    "If you decide to generate an image, respond with a JSON object like this:\n"
-                    '{"type": "image", "content": "<the description of the image to generate>"}\n'
-                    "Do not include any additional text or explanations in your response."
-                )
-            },
-            {
-                "role": "user",
-                "content": instruction_text
-            }
-        ]
-
-        logger.info("Sending request to OpenAI ChatCompletion")
-        chat_response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",  # Use a valid model name
-            messages=messages,
-            max_tokens=500,
-            temperature=0.7
-        )
-        response_text = chat_response['choices'][0]['message']['content'].strip()
-        logger.debug(f"OpenAI response: {response_text}")
-
-        # Parse the response as JSON
-        try:
-            response_data = json.loads(response_text)
-            logger.debug(f"Parsed OpenAI response: {response_data}")
-        except json.JSONDecodeError as e:
-            logger.error("Failed to parse OpenAI response as JSON: %s", e)
-            raise
-
-        # Get the note details to determine its current location
-        note_details_endpoint = f"{target_server}/api/v1/canvases/{canvas_id}/notes/{note_id}"
-        logger.info(f"Requesting note details from {note_details_endpoint}")
-        response = requests.get(note_details_endpoint, headers=headers, timeout=10)
-        logger.debug(f"Response Status Code: {response.status_code}")
-        logger.debug(f"Response Body: {response.text}")
-        response.raise_for_status()
-        note = response.json()
-        logger.debug(f"Retrieved note details: {note}")
+        response_data = await get_response_data(session, instruction_text)
 
         if response_data['type'] == 'text':
             ai_response = response_data['content']
             logger.info("Processing text response from OpenAI")
 
             # Generate a random color for the new note, including transparency set to 80% (CC in hex)
-            random_color = "#{:02x}{:02x}{:02x}CC".format(
-                random.randint(0, 255),
-                random.randint(0, 255),
-                random.randint(0, 255)
-            )
-            logger.debug(f"Generated random color: {random_color}")
+            random_color = f"#{random.getrandbits(24):06x}CC"
+            logger.debug("Generated random color: %s", random_color)
 
             # Prepare data for the new note (AI response)
             new_note_data = {
@@ -258,39 +704,27 @@ def process_instruction(canvas_id, note_id, instruction_text):
             }
 
             # Create the new note as a response
-            create_note_endpoint = f"{target_server}/api/v1/canvases/{canvas_id}/notes"
+            create_note_endpoint = NOTES_URL_TEMPLATE.format(canvas_id=canvas_id)
             logger.info(f"Creating new note at {create_note_endpoint}")
-            response = requests.post(create_note_endpoint, json=new_note_data, headers=headers, timeout=10)
-            logger.debug(f"Response Status Code: {response.status_code}")
-            logger.debug(f"Response Body: {response.text}")
-            response.raise_for_status()
+            async with CANVAS_SEM, session.post(create_note_endpoint, json=new_note_data, headers=CANVAS_HEADERS, timeout=CANVAS_TIMEOUT) as response:
+                logger.debug("Response Status Code: %s", response.status)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Response Body: %s", await response.text())
+                response.raise_for_status()
             logger.info("New note created successfully")
 
             # Now update the original note to mark as 'done'
             updated_text = note['text'].replace('!!Processing!!', '!! Done !!')
-            update_note_endpoint = f"{target_server}/api/v1/canvases/{canvas_id}/notes/{note_id}"
+            update_note_endpoint = NOTE_URL_TEMPLATE.format(canvas_id=canvas_id, note_id=note_id)
             update_data = {"text": updated_text}
             logger.info(f"Updating note ID {note_id} to mark as done")
-            response = requests.patch(update_note_endpoint, json=update_data, headers=headers, timeout=10)
-            response.raise_for_status()
+            async with CANVAS_SEM, session.patch(update_note_endpoint, json=update_data, headers=CANVAS_HEADERS, timeout=CANVAS_TIMEOUT) as response:
+                response.raise_for_status()
 
         elif response_data['type'] == 'image':
             image_description = response_data['content']
             logger.info("Processing image response from OpenAI")
 
-            # Generate image using OpenAI Image API
-            image_response = openai.Image.create(
-                prompt=image_description,
-                n=1,
-                size="512x512"
-            )
-            image_url = image_response['data'][0]['url']
-            logger.debug(f"Generated image URL: {image_url}")
-
-            # Download the image
-            image_data = requests.get(image_url).content
-            logger.info("Image downloaded successfully")
-
             # Prepare data for the new image
             new_image_json = {
                 "title": "AI Generated Image",
@@ -304,27 +738,43 @@ def process_instruction(canvas_id, note_id, instruction_text):
                 # Additional fields can be added if needed
             }
 
-            # Prepare the multipart/form-data request
-            files = {
-                'json': (None, json.dumps(new_image_json), 'application/json'),
-                'data': ('image.png', image_data, 'image/png')
-            }
+            # Small notes don't need a large image, and smaller images generate faster
+            image_size = "256x256" if note['size']['width'] < 400 else "512x512"
+            image_key = (image_description, image_size)
 
-            create_image_endpoint = f"{target_server}/api/v1/canvases/{canvas_id}/images"
-            logger.info(f"Creating new image at {create_image_endpoint}")
-            response = requests.post(create_image_endpoint, headers=headers, files=files, timeout=10)
-            logger.debug(f"Response Status Code: {response.status_code}")
-            logger.debug(f"Response Body: {response.text}")
-            response.raise_for_status()
+            image_data = IMAGE_CACHE.get(image_key)
+            if image_data is not None:
+                logger.info("Reusing cached image for identical description")
+                await upload_image(session, canvas_id, new_image_json, image_data)
+            else:
+                # Generate image using OpenAI Image API
+                image_response = await openai_image(
+                    session,
+                    image_description,
+                    model="dall-e-2",  # Supports the 256x256 size used for small notes
+                    n=1,
+                    size=image_size
+                )
+                image_url = image_response['data'][0]['url']
+                logger.debug("Generated image URL: %s", image_url)
+
+                # Download the image, releasing the connection before the upload starts
+                async with session.get(image_url) as image_download:
+                    image_download.raise_for_status()
+                    image_data = await image_download.read()
+                logger.info("Image downloaded successfully")
+                IMAGE_CACHE[image_key] = image_data
+
+                await upload_image(session, canvas_id, new_image_json, image_data)
             logger.info("New image created successfully")
 
             # Now update the original note to mark as 'done'
             updated_text = note['text'].replace('!!Processing!!', '!! Done !!')
-            update_note_endpoint = f"{target_server}/api/v1/canvases/{canvas_id}/notes/{note_id}"
+            update_note_endpoint = NOTE_URL_TEMPLATE.format(canvas_id=canvas_id, note_id=note_id)
             update_data = {"text": updated_text}
             logger.info(f"Updating note ID {note_id} to mark as done")
-            response = requests.patch(update_note_endpoint, json=update_data, headers=headers, timeout=10)
-            response.raise_for_status()
+            async with CANVAS_SEM, session.patch(update_note_endpoint, json=update_data, headers=CANVAS_HEADERS, timeout=CANVAS_TIMEOUT) as response:
+                response.raise_for_status()
 
         else:
             # If the type is unknown, log an error
@@ -332,16 +782,10 @@ def process_instruction(canvas_id, note_id, instruction_text):
             logger.error(error_message)
             raise ValueError(error_message)
 
-    except requests.exceptions.RequestException as e:
-        logger.exception("A RequestException occurred: %s", e)
-        raise
-    except openai.error.AuthenticationError:
-        logger.error("Invalid OpenAI API key during task execution.")
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.exception("A ClientError occurred: %s", e)
         raise
-    except openai.error.OpenAIError as e:
-        logger.exception("An OpenAIError occurred: %s", e)
-        raise
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         logger.exception("A JSONDecodeError occurred: %s", e)
         raise
     except Exception as e:
@@ -349,4 +793,7 @@ def process_instruction(canvas_id, note_id, instruction_text):
         raise
 
 if __name__ == "__main__":
-    main()
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        logger.info("Monitoring script stopped")